@@ -0,0 +1,165 @@
+"""The Autotuner
+
+OpenCV picks its own DNN backend, target and number of threads, which are
+often a poor fit for machines with many cores. This script benchmarks the
+CPU backends and targets available to OpenCV with different thread counts on
+the bundled LapSRN models, then saves the fastest configuration of every
+scale to the profile that _Thera loads when it wakes up.
+
+    python autotune.py --scales X2 X4 --sizes 128 256
+
+"""
+
+import os
+import json
+import time
+import platform
+import argparse
+import statistics
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+from cv2 import dnn_superres
+
+from model import MODEL_PATHS, DNN_PROFILE_PATH, load_dnn_profile
+
+
+SCALE_CONVERTER = {'X2': 2, 'X4': 4, 'X8': 8}
+
+
+def cpu_backends() -> List[Tuple[int, int]]:
+    """The (backend, target) pairs OpenCV can run the models with on the CPU"""
+    cpu_targets = {cv2.dnn.DNN_TARGET_CPU}
+    if hasattr(cv2.dnn, 'DNN_TARGET_CPU_FP16'):
+        cpu_targets.add(cv2.dnn.DNN_TARGET_CPU_FP16)
+
+    # the backends OpenCV knows about depend on its version, and the ones
+    # it was built with report the targets they can run on
+    backend_ids = sorted({getattr(cv2.dnn, name) for name in dir(cv2.dnn)
+                          if name.startswith('DNN_BACKEND_') and name != 'DNN_BACKEND_DEFAULT'})
+
+    backends = []
+    for backend in backend_ids:
+        try:
+            targets = cv2.dnn.getAvailableTargets(backend)
+        except cv2.error:
+            continue
+        backends.extend((backend, int(target)) for target in targets if int(target) in cpu_targets)
+
+    # the default OpenCV implementation is always there
+    if (cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU) not in backends:
+        backends.insert(0, (cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU))
+
+    return backends
+
+
+def thread_counts() -> List[int]:
+    """Powers of two up to the number of cores, plus the number of cores"""
+    cores = os.cpu_count() or 1
+    counts = []
+    count = 1
+    while count < cores:
+        counts.append(count)
+        count *= 2
+    counts.append(cores)
+
+    return counts
+
+
+def benchmark(multiplier: int, backend: int, target: int, threads: int,
+              sizes: List[int], repeats: int = 3) -> float:
+    """Time the upsampling of square images of the given sizes
+
+    :return: the sum over the sizes of the median time in seconds
+    """
+    sr = dnn_superres.DnnSuperResImpl_create()
+    sr.readModel(MODEL_PATHS[multiplier])
+    sr.setModel('lapsrn', multiplier)
+    sr.setPreferableBackend(backend)
+    sr.setPreferableTarget(target)
+    cv2.setNumThreads(threads)
+
+    # the running time of the model does not depend on the content of the image
+    rng = np.random.default_rng(0)
+    total = 0.0
+
+    for size in sizes:
+        image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+
+        # the first run also initializes the network for this input size
+        sr.upsample(image)
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            sr.upsample(image)
+            timings.append(time.perf_counter() - start)
+        total += statistics.median(timings)
+
+    return total
+
+
+def autotune(multipliers: List[int], sizes: List[int], repeats: int = 3) -> dict:
+    default_threads = cv2.getNumThreads()
+    scales = {}
+
+    try:
+        for multiplier in multipliers:
+            best = None
+
+            for backend, target in cpu_backends():
+                for threads in thread_counts():
+                    try:
+                        seconds = benchmark(multiplier, backend, target, threads, sizes, repeats)
+                    except cv2.error as e:
+                        # the backend is listed but can't run this model
+                        print(f"X{multiplier} backend={backend} target={target} failed: {e.msg}")
+                        break
+
+                    print(f"X{multiplier} backend={backend} target={target} "
+                          f"threads={threads}: {seconds:.3f}s")
+                    if best is None or seconds < best['seconds']:
+                        best = {'backend': backend, 'target': target,
+                                'threads': threads, 'seconds': seconds}
+
+            if best is not None:
+                scales[str(multiplier)] = best
+    finally:
+        cv2.setNumThreads(default_threads)
+
+    return {
+        'host': platform.node(), 'cpu_count': os.cpu_count(),
+        'opencv': cv2.__version__, 'sizes': sizes, 'scales': scales,
+    }
+
+
+def save_profile(profile: dict, path: str = DNN_PROFILE_PATH) -> None:
+    partial = f"{path}.part"
+    with open(partial, 'w') as profile_file:
+        json.dump(profile, profile_file, indent=2)
+    os.replace(partial, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Find the fastest OpenCV DNN configuration of this machine for super resolution")
+    parser.add_argument('--scales', nargs='+', choices=list(SCALE_CONVERTER), default=list(SCALE_CONVERTER))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[128, 256],
+                        help="side lengths of the square images used for the benchmark")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--profile', default=DNN_PROFILE_PATH,
+                        help="where the profile is saved, _Thera reads it from the default location")
+    args = parser.parse_args()
+
+    result = autotune([SCALE_CONVERTER[scale] for scale in args.scales], args.sizes, args.repeats)
+
+    # keep the configuration of the scales that were not tuned this time
+    previous = {str(multiplier): config for multiplier, config in load_dnn_profile(args.profile).items()}
+    result['scales'] = {**previous, **result['scales']}
+    save_profile(result, args.profile)
+
+    for multiplier, config in result['scales'].items():
+        print(f"X{multiplier}: backend={config['backend']} target={config['target']} "
+              f"threads={config['threads']} ({config['seconds']:.3f}s)")
+    print(f"Profile saved to {args.profile}")
@@ -0,0 +1,443 @@
+"""The Batch
+
+Splits a large enlargement run across several worker processes, on one
+machine or on many machines sharing the same storage. The entries of the run
+are kept in a SQLite manifest, the workers claim them a shard at a time under
+a lease, and the entries of a worker that crashed are claimed again by the
+others once its lease expires.
+
+    python batch.py init run.sqlite manifest.csv
+    python batch.py work run.sqlite                 # on every node
+    python batch.py run run.sqlite --processes 4    # several workers on this machine
+    python batch.py report run.sqlite
+
+The manifest CSV has the columns source, method, scale and destination, where
+method is Bilinear, Cubic, Lanczos or Super Resolution and scale is X2, X4 or X8.
+SQLite relies on the file locks of the shared storage, which must support them.
+
+"""
+
+import os
+import csv
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from typing import Iterable, List, Optional, Tuple
+
+import cv2
+
+from model import _Thera, get_upscale
+from checkpoint import CheckpointedJob, CHECKPOINT_MIN_PIXELS
+from frames import FrameStreamEnlarger, supports_frame_streaming
+
+
+METHODS = ('Bilinear', 'Cubic', 'Lanczos', 'Super Resolution')
+SCALE_CONVERTER = {'X2': 2, 'X4': 4, 'X8': 8}
+
+Entry = Tuple[int, str, str, int, str]
+
+
+class BatchManifest:
+    """The entries of a batch run and their progress, in a SQLite file
+
+    Every claim happens in an immediate transaction, so two workers never
+    get the same entry while its lease is running
+    """
+    def __init__(self, path: str, timeout: float = 60.0):
+        # transactions are handled by hand, to take the write lock before
+        # looking for entries to claim
+        self.__connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "id INTEGER PRIMARY KEY, source TEXT NOT NULL, method TEXT NOT NULL, "
+            "scale INTEGER NOT NULL, destination TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_expires REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, pixels INTEGER, "
+            "started REAL, finished REAL, error TEXT, retry_after REAL, "
+            "UNIQUE (source, method, scale, destination))"
+        )
+
+        # manifests created before failed entries were held back
+        columns = [row[1] for row in self.__connection.execute("PRAGMA table_info(entries)")]
+        if 'retry_after' not in columns:
+            self.__connection.execute("ALTER TABLE entries ADD COLUMN retry_after REAL")
+
+    def close(self) -> None:
+        self.__connection.close()
+
+    def add_entries(self, entries: Iterable[Tuple[str, str, int, str]]) -> int:
+        """Add (source, method, scale, destination) entries, the entries
+        already in the manifest are left as they are
+
+        :return: the number of entries added
+        """
+        before = self.__connection.total_changes
+        self.__connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.__connection.executemany(
+                "INSERT OR IGNORE INTO entries (source, method, scale, destination) VALUES (?, ?, ?, ?)",
+                entries)
+        except BaseException:
+            self.__connection.execute("ROLLBACK")
+            raise
+        self.__connection.execute("COMMIT")
+
+        return self.__connection.total_changes - before
+
+    def claim_shard(self, worker: str, shard_size: int, lease_seconds: float,
+                    max_attempts: int) -> List[Entry]:
+        """Claim up to shard_size pending entries, or entries whose lease expired
+
+        An entry that failed is left to the other workers, the worker it
+        failed on only gets it back once its retry delay is over. An entry
+        whose lease expired after max_attempts is given up on, the workers
+        that started it were lost while enlarging it, most likely because it
+        makes them crash. Claiming does not count as an attempt, the rest of
+        the shard of a lost worker is not held responsible for it
+        """
+        now = time.time()
+
+        self.__connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.__connection.execute(
+                "UPDATE entries SET status = 'failed', error = 'worker lost', finished = ?, "
+                "lease_expires = NULL WHERE status = 'claimed' AND lease_expires < ? AND attempts >= ?",
+                (now, now, max_attempts))
+
+            entries = self.__connection.execute(
+                "SELECT id, source, method, scale, destination FROM entries "
+                "WHERE (status = 'pending' AND (worker IS NULL OR worker != ? OR retry_after <= ?)) "
+                "OR (status = 'claimed' AND lease_expires < ?) "
+                "ORDER BY id LIMIT ?", (worker, now, now, shard_size)).fetchall()
+
+            self.__connection.executemany(
+                "UPDATE entries SET status = 'claimed', worker = ?, lease_expires = ? WHERE id = ?",
+                [(worker, now + lease_seconds, entry[0]) for entry in entries])
+        except BaseException:
+            self.__connection.execute("ROLLBACK")
+            raise
+        self.__connection.execute("COMMIT")
+
+        return entries
+
+    def start(self, entry_id: int, worker: str) -> bool:
+        """Count an attempt on the entry, right before it is enlarged
+
+        :return: False if the lease was lost and the entry was claimed by another worker
+        """
+        cursor = self.__connection.execute(
+            "UPDATE entries SET attempts = attempts + 1, started = ?, error = NULL "
+            "WHERE id = ? AND worker = ? AND status = 'claimed'",
+            (time.time(), entry_id, worker))
+        return cursor.rowcount == 1
+
+    def renew_leases(self, worker: str, lease_seconds: float) -> None:
+        """Extend the lease of every entry the worker holds"""
+        self.__connection.execute(
+            "UPDATE entries SET lease_expires = ? WHERE worker = ? AND status = 'claimed'",
+            (time.time() + lease_seconds, worker))
+
+    def complete(self, entry_id: int, worker: str, pixels: int = None) -> bool:
+        """Mark the entry as done
+
+        :return: False if the lease was lost and the entry was claimed by another worker
+        """
+        cursor = self.__connection.execute(
+            "UPDATE entries SET status = 'done', pixels = ?, finished = ?, lease_expires = NULL "
+            "WHERE id = ? AND worker = ? AND status = 'claimed'",
+            (pixels, time.time(), entry_id, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, entry_id: int, worker: str, error: str, max_attempts: int,
+             retry_delay: float) -> None:
+        """Put the entry back in the queue, or give up on it after max_attempts
+
+        The worker is kept on the entry, it may only claim it again after
+        retry_delay seconds times the number of attempts so far
+        """
+        now = time.time()
+        self.__connection.execute(
+            "UPDATE entries SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = ?, finished = ?, lease_expires = NULL, retry_after = ? + ? * attempts "
+            "WHERE id = ? AND worker = ? AND status = 'claimed'",
+            (max_attempts, error, now, now, retry_delay, entry_id, worker))
+
+    def release(self, worker: str, ids: Iterable[int]) -> None:
+        """Give back claimed entries that were not started"""
+        self.__connection.executemany(
+            "UPDATE entries SET status = 'pending', worker = NULL, lease_expires = NULL "
+            "WHERE id = ? AND worker = ? AND status = 'claimed'",
+            [(entry_id, worker) for entry_id in ids])
+
+    def abandon(self, entry_id: int, worker: str) -> None:
+        """Give back an entry whose enlargement was interrupted by the user,
+        without counting the interrupted attempt"""
+        self.__connection.execute(
+            "UPDATE entries SET status = 'pending', worker = NULL, lease_expires = NULL, "
+            "attempts = attempts - 1 WHERE id = ? AND worker = ? AND status = 'claimed'",
+            (entry_id, worker))
+
+    def outstanding(self) -> int:
+        """The number of entries that are not done or failed yet"""
+        return self.__connection.execute(
+            "SELECT COUNT(*) FROM entries WHERE status IN ('pending', 'claimed')").fetchone()[0]
+
+    def report(self) -> dict:
+        counts = dict(self.__connection.execute(
+            "SELECT status, COUNT(*) FROM entries GROUP BY status").fetchall())
+
+        first_started, last_finished, done_pixels = self.__connection.execute(
+            "SELECT MIN(started), MAX(finished), SUM(pixels) FROM entries WHERE status = 'done'").fetchone()
+        elapsed = (last_finished - first_started) if first_started is not None else 0.0
+
+        workers = {}
+        for worker, done, pixels, started, finished in self.__connection.execute(
+                "SELECT worker, COUNT(*), SUM(pixels), MIN(started), MAX(finished) "
+                "FROM entries WHERE status = 'done' GROUP BY worker"):
+            worker_elapsed = finished - started
+            workers[worker] = {
+                'done': done, 'pixels': pixels or 0,
+                'entries_per_minute': done * 60 / worker_elapsed if worker_elapsed > 0 else None,
+            }
+
+        return {
+            'total': sum(counts.values()),
+            'pending': counts.get('pending', 0), 'claimed': counts.get('claimed', 0),
+            'done': counts.get('done', 0), 'failed': counts.get('failed', 0),
+            'elapsed': elapsed,
+            'entries_per_minute': counts.get('done', 0) * 60 / elapsed if elapsed > 0 else None,
+            'megapixels_per_second': (done_pixels or 0) / 1e6 / elapsed if elapsed > 0 else None,
+            'workers': workers,
+        }
+
+
+class BatchWorker:
+    """Claim shards of the manifest and enlarge them with _Thera until
+    every entry is done or failed
+
+    :param lease_seconds: how long a claim holds without news from the worker,
+        a heartbeat renews it every third of that while the worker is alive
+    :param retry_delay: how long, times the attempts so far, before a worker
+        may retry an entry that failed on it, other workers can retry it at once
+    """
+    def __init__(self, manifest_path: str, worker_id: str = None, shard_size: int = 4,
+                 lease_seconds: float = 600.0, max_attempts: int = 3, poll_interval: float = 5.0,
+                 retry_delay: float = 60.0):
+        self.manifest_path = manifest_path
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.shard_size = shard_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+
+    def enlarge(self, thera: _Thera, source: str, method: str, scale: int,
+                destination: str) -> Optional[int]:
+        """Enlarge one entry
+
+        :return: the number of pixels of the source, used for the throughput,
+            None for animations and multi-page images
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+
+        if supports_frame_streaming(source, destination):
+            FrameStreamEnlarger(lambda: thera).run(source, destination, method, scale)
+            return None
+
+        image = cv2.imread(source)
+        if image is None:
+            raise ValueError("This image is corrupted")
+        pixels = image.shape[0] * image.shape[1]
+
+        # a large super resolution entry claimed again after a crash resumes
+        # from the tiles saved by the previous worker
+        if method == 'Super Resolution' and pixels >= CHECKPOINT_MIN_PIXELS:
+            if not CheckpointedJob(source, destination, method, scale).run(thera, image):
+                raise OSError(f"Could not write the image to {destination}")
+        else:
+            image = thera.enlarge(image, get_upscale(image, scale), method)
+            thera.save_enlarged_image(image, destination)
+
+        return pixels
+
+    def _heartbeat(self, stop: threading.Event) -> None:
+        # sqlite connections can't be shared between threads
+        manifest = BatchManifest(self.manifest_path)
+        try:
+            while not stop.wait(self.lease_seconds / 3):
+                # a busy or briefly unreachable manifest must not stop the
+                # heartbeat, the next beat tries again while the lease runs
+                try:
+                    manifest.renew_leases(self.worker_id, self.lease_seconds)
+                except sqlite3.Error as e:
+                    print(f"[{self.worker_id}] Could not renew the leases: {e}")
+        finally:
+            manifest.close()
+
+    def run(self) -> None:
+        manifest = BatchManifest(self.manifest_path)
+        thera = _Thera()
+        shard = []
+        in_flight = None
+
+        # the leases stay alive as long as the process does, however long
+        # a single entry takes, and expire with it when it crashes
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(stop_heartbeat,), daemon=True)
+        heartbeat.start()
+
+        try:
+            while True:
+                shard = manifest.claim_shard(self.worker_id, self.shard_size, self.lease_seconds,
+                                             self.max_attempts)
+
+                if not shard:
+                    if not manifest.outstanding():
+                        break
+
+                    # the rest is claimed by other workers or waits for its
+                    # retry delay, wait in case one of them crashes and its
+                    # lease expires
+                    time.sleep(self.poll_interval)
+                    continue
+
+                while shard:
+                    entry_id, source, method, scale, destination = shard[0]
+
+                    # an entry whose lease was lost is another worker's now
+                    if not manifest.start(entry_id, self.worker_id):
+                        shard.pop(0)
+                        continue
+                    in_flight = entry_id
+
+                    try:
+                        pixels = self.enlarge(thera, source, method, scale, destination)
+                    except Exception as e:
+                        # whatever goes wrong, down to running out of memory,
+                        # is held against this entry alone
+                        manifest.fail(entry_id, self.worker_id, f"{type(e).__name__}: {e}",
+                                      self.max_attempts, self.retry_delay)
+                        print(f"[{self.worker_id}] Failed {source}: {e}")
+                    else:
+                        if manifest.complete(entry_id, self.worker_id, pixels):
+                            print(f"[{self.worker_id}] Enlarged {source} -> {destination}")
+                        else:
+                            print(f"[{self.worker_id}] Enlarged {source}, but the lease was lost and "
+                                  f"the entry was claimed by another worker")
+                    in_flight = None
+                    shard.pop(0)
+        except (KeyboardInterrupt, SystemExit):
+            # stopped by the user, the entry being enlarged is not to blame
+            if in_flight is not None:
+                manifest.abandon(in_flight, self.worker_id)
+                in_flight = None
+            raise
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+
+            # let the other workers have the entries that were never started
+            # straight away. An entry that was being enlarged when anything
+            # else went wrong keeps its lease until it expires, and the
+            # attempt counts
+            unstarted = [entry[0] for entry in shard if entry[0] != in_flight]
+            if unstarted:
+                manifest.release(self.worker_id, unstarted)
+            manifest.close()
+
+
+def read_manifest_csv(path: str) -> List[Tuple[str, str, int, str]]:
+    entries = []
+    with open(path, newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            method = row['method'].strip()
+            if method not in METHODS:
+                raise ValueError(f"Unknown enlargement method: {method}")
+
+            scale = row['scale'].strip().upper()
+            scale = SCALE_CONVERTER[scale if scale.startswith('X') else f"X{scale}"]
+
+            entries.append((os.path.abspath(row['source'].strip()), method, scale,
+                            os.path.abspath(row['destination'].strip())))
+    return entries
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['done']} / {report['total']} done, {report['failed']} failed, "
+          f"{report['claimed']} in progress, {report['pending']} pending")
+
+    if report['entries_per_minute'] is not None:
+        print(f"Throughput: {report['entries_per_minute']:.1f} images / minute, "
+              f"{report['megapixels_per_second']:.2f} source megapixels / second "
+              f"over {report['elapsed']:.0f}s")
+
+    for worker, stats in sorted(report['workers'].items()):
+        rate = f"{stats['entries_per_minute']:.1f} images / minute" \
+            if stats['entries_per_minute'] is not None else "-"
+        print(f"  {worker}: {stats['done']} done, {rate}")
+
+
+def _run_worker(manifest_path: str, worker_id: str, shard_size: int, lease_seconds: float,
+                retry_delay: float) -> None:
+    BatchWorker(manifest_path, worker_id=worker_id, shard_size=shard_size,
+                lease_seconds=lease_seconds, retry_delay=retry_delay).run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Enlarge a manifest of images with several workers")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = subparsers.add_parser('init', help="add the entries of a CSV manifest to the run")
+    init_parser.add_argument('database')
+    init_parser.add_argument('csv', help="CSV with the columns source, method, scale, destination")
+
+    for name, description in (('work', "run one worker"), ('run', "run several workers on this machine")):
+        worker_parser = subparsers.add_parser(name, help=description)
+        worker_parser.add_argument('database')
+        worker_parser.add_argument('--shard-size', type=int, default=4)
+        worker_parser.add_argument('--lease', type=float, default=600.0,
+                                   help="seconds before the entries of a silent worker are claimed again")
+        worker_parser.add_argument('--retry-delay', type=float, default=60.0,
+                                   help="seconds, times the attempts, before a worker retries an entry "
+                                        "that failed on it")
+        if name == 'work':
+            worker_parser.add_argument('--worker-id', default=None)
+        else:
+            worker_parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+
+    report_parser = subparsers.add_parser('report', help="show the progress and throughput of the run")
+    report_parser.add_argument('database')
+
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        manifest = BatchManifest(args.database)
+        added = manifest.add_entries(read_manifest_csv(args.csv))
+        manifest.close()
+        print(f"Added {added} entries to {args.database}")
+
+    elif args.command == 'work':
+        BatchWorker(args.database, worker_id=args.worker_id, shard_size=args.shard_size,
+                    lease_seconds=args.lease, retry_delay=args.retry_delay).run()
+
+    elif args.command == 'run':
+        processes = [
+            multiprocessing.Process(
+                target=_run_worker,
+                args=(args.database, f"{socket.gethostname()}-{os.getpid()}-{index}",
+                      args.shard_size, args.lease, args.retry_delay))
+            for index in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    if args.command in ('run', 'report'):
+        manifest = BatchManifest(args.database)
+        print_report(manifest.report())
+        manifest.close()
@@ -0,0 +1,209 @@
+"""The Batch self test
+
+Runs a small batch in a temporary folder with several real worker processes
+and checks the claims, the leases and the retries of batch.py end to end:
+
+- every valid image is enlarged exactly once, by the workers that are alive
+- the shard of a worker killed while holding it is claimed again once its
+  lease expires
+- a corrupted image is retried on other workers, then given up on after
+  max_attempts
+- an entry that keeps killing its workers is given up on after
+  max_attempts, without taking the rest of their shards down with it
+- an unexpected error, such as running out of memory, fails the entry it
+  happened on and the worker goes on with the others
+- no partial file is left behind
+
+    python batch_selftest.py --processes 3
+
+Only the Bilinear method is used, the models are not needed.
+
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import multiprocessing
+
+import cv2
+import numpy as np
+
+from batch import BatchManifest, BatchWorker
+
+
+IMAGE_COUNT = 12
+LEASE_SECONDS = 1.0
+MAX_ATTEMPTS = 3
+
+
+def _claim_and_hang(manifest_path: str, worker_id: str, shard_size: int) -> None:
+    """A worker that claims a shard and then stops responding, until killed"""
+    manifest = BatchManifest(manifest_path)
+    manifest.claim_shard(worker_id, shard_size, LEASE_SECONDS, MAX_ATTEMPTS)
+    while True:
+        time.sleep(1)
+
+
+def _start_and_hang(manifest_path: str, worker_id: str, shard_size: int) -> None:
+    """A worker that dies while enlarging the first entry of its shard"""
+    manifest = BatchManifest(manifest_path)
+    shard = manifest.claim_shard(worker_id, shard_size, LEASE_SECONDS, MAX_ATTEMPTS)
+    manifest.start(shard[0][0], worker_id)
+    while True:
+        time.sleep(1)
+
+
+class _ExplodingWorker(BatchWorker):
+    """Runs out of memory on the images with 'explodes' in their name"""
+    def enlarge(self, thera, source, method, scale, destination):
+        if 'explodes' in source:
+            raise MemoryError("simulated")
+        return super().enlarge(thera, source, method, scale, destination)
+
+
+def _run_worker(manifest_path: str, worker_id: str, worker_class=BatchWorker) -> None:
+    worker_class(manifest_path, worker_id=worker_id, shard_size=2, lease_seconds=LEASE_SECONDS,
+                 max_attempts=MAX_ATTEMPTS, poll_interval=0.2, retry_delay=0.5).run()
+
+
+def _run_workers(manifest_path: str, processes: int, worker_class=BatchWorker) -> None:
+    workers = [multiprocessing.Process(target=_run_worker,
+                                       args=(manifest_path, f"worker-{index}", worker_class))
+               for index in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=120)
+        assert worker.exitcode == 0, f"a worker exited with {worker.exitcode}"
+
+
+def _make_entries(folder: str, names) -> list:
+    entries = []
+    for name in names:
+        source = os.path.join(folder, f"{name}.png")
+        cv2.imwrite(source, np.random.randint(0, 256, (48, 64, 3), dtype=np.uint8))
+        entries.append((source, 'Bilinear', 2, os.path.join(folder, 'enlarged', f"{name}_x2.png")))
+    return entries
+
+
+def _entry_states(manifest_path: str) -> dict:
+    """source name -> (status, attempts, error)"""
+    connection = sqlite3.connect(manifest_path)
+    rows = connection.execute("SELECT source, status, attempts, error FROM entries").fetchall()
+    connection.close()
+    return {os.path.basename(source): (status, attempts, error) for source, status, attempts, error in rows}
+
+
+def _wait_for(condition, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.1)
+
+
+def check_workers(folder: str, processes: int) -> None:
+    manifest_path = os.path.join(folder, 'run.sqlite')
+    output_dir = os.path.join(folder, 'enlarged')
+
+    entries = _make_entries(folder, [f"image_{index}" for index in range(IMAGE_COUNT)])
+
+    corrupted = os.path.join(folder, 'corrupted.png')
+    with open(corrupted, 'wb') as corrupted_file:
+        corrupted_file.write(b'not an image')
+    entries.append((corrupted, 'Bilinear', 2, os.path.join(output_dir, 'corrupted_x2.png')))
+
+    manifest = BatchManifest(manifest_path)
+    manifest.add_entries(entries)
+
+    # the lost worker claims the first shard before the others start
+    lost = multiprocessing.Process(target=_claim_and_hang, args=(manifest_path, 'lost-worker', 2))
+    lost.start()
+    _wait_for(lambda: manifest.report()['claimed'] == 2, timeout=30)
+    lost.kill()
+    lost.join()
+
+    _run_workers(manifest_path, processes)
+
+    report = manifest.report()
+    assert report['done'] == IMAGE_COUNT, report
+    assert report['failed'] == 1, report
+    assert report['pending'] == report['claimed'] == 0, report
+    assert 'lost-worker' not in report['workers'], report
+    manifest.close()
+
+    for source, _, _, destination in entries[:IMAGE_COUNT]:
+        assert cv2.imread(destination).shape[:2] == (96, 128), destination
+
+    assert not any('.part' in name for name in os.listdir(output_dir)), os.listdir(output_dir)
+    assert not os.path.exists(os.path.join(output_dir, 'corrupted_x2.png'))
+
+    print(f"Workers: {report['done']} done, {report['failed']} failed as expected, "
+          f"done by {', '.join(sorted(report['workers']))}")
+
+
+def check_lost_workers(folder: str) -> None:
+    manifest_path = os.path.join(folder, 'lost.sqlite')
+    entries = _make_entries(folder, ['crashing', 'lost_0', 'lost_1', 'lost_2'])
+
+    manifest = BatchManifest(manifest_path)
+    manifest.add_entries(entries)
+
+    # every worker that claims the shard dies on its first entry
+    for attempt in range(MAX_ATTEMPTS):
+        lost = multiprocessing.Process(target=_start_and_hang,
+                                       args=(manifest_path, f"lost-{attempt}", len(entries)))
+        lost.start()
+        _wait_for(lambda: _entry_states(manifest_path)['crashing.png'][1] == attempt + 1, timeout=30)
+        lost.kill()
+        lost.join()
+
+        # the shard can only be claimed again once the lease expired
+        time.sleep(LEASE_SECONDS)
+    manifest.close()
+
+    _run_workers(manifest_path, 1)
+
+    states = _entry_states(manifest_path)
+    assert states['crashing.png'] == ('failed', MAX_ATTEMPTS, 'worker lost'), states
+    for name in ('lost_0.png', 'lost_1.png', 'lost_2.png'):
+        assert states[name][:2] == ('done', 1), states
+
+    print(f"Lost workers: the entry was given up on after {MAX_ATTEMPTS} attempts, "
+          f"the rest of the shard was enlarged")
+
+
+def check_unexpected_errors(folder: str, processes: int) -> None:
+    manifest_path = os.path.join(folder, 'errors.sqlite')
+    entries = _make_entries(folder, ['explodes', 'fine_0', 'fine_1', 'fine_2'])
+
+    manifest = BatchManifest(manifest_path)
+    manifest.add_entries(entries)
+    manifest.close()
+
+    _run_workers(manifest_path, processes, _ExplodingWorker)
+
+    states = _entry_states(manifest_path)
+    assert states['explodes.png'] == ('failed', MAX_ATTEMPTS, 'MemoryError: simulated'), states
+    for name in ('fine_0.png', 'fine_1.png', 'fine_2.png'):
+        assert states[name][:2] == ('done', 1), states
+
+    print(f"Unexpected errors: the entry failed after {MAX_ATTEMPTS} attempts, the workers went on")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check batch.py with several worker processes")
+    parser.add_argument('--processes', type=int, default=3)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='thera_batch_')
+    try:
+        check_workers(folder, args.processes)
+        check_lost_workers(folder)
+        check_unexpected_errors(folder, args.processes)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    print("Self test passed")
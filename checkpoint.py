@@ -0,0 +1,205 @@
+"""Checkpointed enlargement
+
+A large super resolution job can run for minutes, and everything used to be
+held in memory until the final cv2.imwrite, so a killed process lost all of
+the work. Here the image is enlarged tile by tile and every finished tile is
+saved, together with a manifest of the job, into a scratch folder next to the
+destination. Running the same job again only computes the missing tiles.
+
+"""
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+from typing import Callable, Optional
+
+import cv2
+import numpy as np
+
+
+# super resolution jobs on images smaller than this are fast enough that
+# checkpointing them is not worth the extra disk writes
+CHECKPOINT_MIN_PIXELS = 512 * 512
+
+MANIFEST_NAME = "manifest.json"
+
+
+def partial_path(filename: str) -> str:
+    """A temporary name next to filename, unique to the caller so that two
+    processes writing the same file, possibly on different machines sharing
+    the storage, never write into each other's partial file
+
+    The extension is kept, cv2 and Pillow pick the encoder from it
+    """
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{uuid.uuid4().hex[:12]}.part{ext}"
+
+
+def atomic_imwrite(filename: str, image: np.ndarray) -> bool:
+    """Write the image next to filename first and move it into place once it
+    is complete, so that filename never holds a half written image"""
+    partial = partial_path(filename)
+    if not cv2.imwrite(partial, image):
+        return False
+
+    os.replace(partial, filename)
+    return True
+
+
+class CheckpointedJob:
+    """Enlarge an image tile by tile, persisting the finished tiles
+
+    Every tile is enlarged together with a margin of overlap pixels of its
+    neighbours, the margin is cropped away afterwards, so the convolutions of
+    the model see the same context they would see on the whole image.
+
+    :param source: path of the image to enlarge, its size and modification
+        time identify the job together with the method and scale
+    :param filename: where the enlarged image is saved
+    :param interpolation: any method accepted by _Thera.enlarge
+    :param multiplier: the scale multiplier
+    """
+    def __init__(self, source: str, filename: str, interpolation: str, multiplier: int,
+                 tile_size: int = 256, overlap: int = 16, scratch_root: str = None):
+        self.source = os.path.abspath(source)
+        self.filename = os.path.abspath(filename)
+        self.interpolation = interpolation
+        self.multiplier = multiplier
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+        # keep the scratch data on the same disk as the destination, the
+        # temporary folder of the system may be wiped by a reboot
+        if scratch_root is None:
+            scratch_root = os.path.join(os.path.dirname(self.filename), '.thera_checkpoints')
+
+        stat = os.stat(self.source)
+        key = json.dumps([self.source, stat.st_size, stat.st_mtime, self.filename,
+                          interpolation, multiplier, tile_size, overlap])
+        self.job_id = hashlib.sha1(key.encode()).hexdigest()[:16]
+        self.scratch_dir = os.path.join(scratch_root, self.job_id)
+
+    def tile_path(self, row: int, col: int) -> str:
+        return os.path.join(self.scratch_dir, f"tile_{row}_{col}.png")
+
+    def _load_or_create_manifest(self, image: np.ndarray) -> dict:
+        manifest_path = os.path.join(self.scratch_dir, MANIFEST_NAME)
+        height, width = image.shape[:2]
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+
+            if manifest['shape'] == list(image.shape):
+                return manifest
+
+            # the checkpoint belongs to some other image, start over
+            shutil.rmtree(self.scratch_dir)
+
+        manifest = {
+            'source': self.source, 'destination': self.filename,
+            'interpolation': self.interpolation, 'multiplier': self.multiplier,
+            'tile_size': self.tile_size, 'overlap': self.overlap,
+            'shape': list(image.shape),
+            'rows': -(-height // self.tile_size), 'cols': -(-width // self.tile_size),
+        }
+
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        partial = partial_path(manifest_path)
+        with open(partial, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(partial, manifest_path)
+
+        return manifest
+
+    def _enlarge_tile(self, thera, image: np.ndarray, row: int, col: int) -> np.ndarray:
+        height, width = image.shape[:2]
+        top, left = row * self.tile_size, col * self.tile_size
+        bottom, right = min(top + self.tile_size, height), min(left + self.tile_size, width)
+
+        # the tile together with the overlap, clipped at the image borders
+        padded_top, padded_left = max(top - self.overlap, 0), max(left - self.overlap, 0)
+        padded_bottom = min(bottom + self.overlap, height)
+        padded_right = min(right + self.overlap, width)
+        padded = image[padded_top:padded_bottom, padded_left:padded_right]
+
+        upscale = (((padded_right - padded_left) * self.multiplier,
+                    (padded_bottom - padded_top) * self.multiplier), self.multiplier)
+        enlarged = thera.enlarge(np.ascontiguousarray(padded), upscale, self.interpolation)
+
+        m = self.multiplier
+        crop_top, crop_left = (top - padded_top) * m, (left - padded_left) * m
+        return enlarged[crop_top:crop_top + (bottom - top) * m,
+                        crop_left:crop_left + (right - left) * m]
+
+    def run(self, thera, image: np.ndarray = None,
+            progress: Optional[Callable[[int, int], None]] = None) -> bool:
+        """Enlarge the missing tiles, then assemble and save the final image
+
+        :param thera: the _Thera instance used to enlarge the tiles
+        :param image: the source image if it was already read with cv2.imread
+        :param progress: called with the number of finished tiles and the total
+        :return: whether the final image was saved
+        """
+        if image is None:
+            image = cv2.imread(self.source)
+            if image is None:
+                return False
+
+        manifest = self._load_or_create_manifest(image)
+        rows, cols = manifest['rows'], manifest['cols']
+        total = rows * cols
+        finished = 0
+
+        for row in range(rows):
+            for col in range(cols):
+                tile_path = self.tile_path(row, col)
+
+                if not os.path.exists(tile_path):
+                    tile = self._enlarge_tile(thera, image, row, col)
+
+                    # an other process running the same job may have finished
+                    # it and removed the scratch folder in the meantime
+                    os.makedirs(self.scratch_dir, exist_ok=True)
+
+                    # PNG is lossless, the assembled image is identical to
+                    # enlarging without checkpoints
+                    if not atomic_imwrite(tile_path, tile):
+                        return False
+
+                finished += 1
+                if progress is not None:
+                    progress(finished, total)
+
+        height, width = image.shape[:2]
+        m = self.multiplier
+        result = np.empty((height * m, width * m) + image.shape[2:], dtype=image.dtype)
+
+        for row in range(rows):
+            for col in range(cols):
+                top, left = row * self.tile_size * m, col * self.tile_size * m
+                expected = result[top:top + self.tile_size * m, left:left + self.tile_size * m].shape
+
+                # a tile removed or damaged since it was saved is not finished,
+                # it is enlarged again
+                tile_path = self.tile_path(row, col)
+                tile = cv2.imread(tile_path, cv2.IMREAD_UNCHANGED) if os.path.exists(tile_path) else None
+                if tile is None or tile.shape != expected:
+                    tile = self._enlarge_tile(thera, image, row, col)
+
+                result[top:top + tile.shape[0], left:left + tile.shape[1]] = tile
+
+        if not atomic_imwrite(self.filename, result):
+            return False
+
+        # the final image is safely in place, the checkpoint is not needed anymore
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(self.scratch_dir))
+        except OSError:
+            # other jobs still have checkpoints in there
+            pass
+
+        return True
@@ -10,12 +10,18 @@ while the model and view are encapsulated
 
 """
 
+import os
 import sys
+
+# OpenCV refuses to decode images above 2^30 pixels by default, which the
+# X8 enlargements easily go past, the limit is read when cv2 is imported
+os.environ.setdefault("OPENCV_IO_MAX_IMAGE_PIXELS", str(2 ** 40))
+
 from PyQt6.QtWidgets import QApplication, QSplashScreen
 from PyQt6.QtGui import QPixmap
 
 
-from maininterface import MainInterface, EnlargeImageInterface, AboutInterface
+from maininterface import MainInterface, EnlargeImageInterface, AboutInterface, ZoomViewInterface
 from model import Model
 
 
@@ -54,6 +60,8 @@ class Controller(object):
         # only initialize dialog box when needed
         self.view.action_image_enlargement.triggered.connect(
             lambda: self.model.open_enlargement_dialog_box(EnlargeImageInterface(self.view)))
+        self.view.action_zoom_view.triggered.connect(
+            lambda: self.model.open_zoom_view(ZoomViewInterface(self.view)))
 
     def handle_miscellaneous_signal(self):
         self.view.miscellaneous_event.resize.connect(lambda: self.model.resize_image(self.view))
@@ -65,6 +73,9 @@ class Controller(object):
         self.view.miscellaneous_event.enlargement_finished.connect(
             lambda: self.model.end_of_enlargement_notification(self.view)
         )
+        self.view.miscellaneous_event.enlargement_failed.connect(
+            lambda message: self.model.end_of_enlargement_error(self.view, message)
+        )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,262 @@
+"""Frame streaming enlargement
+
+cv2.imread only decodes the first frame of an animated GIF or the first page
+of a multi-page TIFF. Here the frames are decoded with Pillow one at a time,
+enlarged with _Thera and encoded into the output file as soon as they are
+ready, so the memory used does not grow with the number of frames.
+
+    python frames.py animation.gif animation_x2.gif --method Lanczos --scale X2 --workers 4
+
+"""
+
+from __future__ import annotations
+
+import os
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Callable, Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+
+try:
+    from PIL import Image, GifImagePlugin, TiffImagePlugin
+except ImportError:
+    # Pillow is only needed to enlarge animations and multi-page images
+    Image = GifImagePlugin = TiffImagePlugin = None
+
+from checkpoint import partial_path
+
+
+FRAME_FORMATS = ('gif', 'tif', 'tiff')
+
+# the TIFF tags copied from every source page to the enlarged page
+TIFF_METADATA_TAGS = (
+    269,    # DocumentName
+    270,    # ImageDescription
+    285,    # PageName
+    305,    # Software
+    306,    # DateTime
+    315,    # Artist
+    33432,  # Copyright
+)
+
+
+def supports_frame_streaming(source: str, filename: str) -> bool:
+    """Whether both the source and the destination are animation or
+    multi-page formats"""
+    return all(os.path.splitext(path)[1][1:].lower() in FRAME_FORMATS for path in (source, filename))
+
+
+def _require_pillow() -> None:
+    if Image is None:
+        raise ImportError("Pillow is required to enlarge animated GIFs and multi-page TIFFs, "
+                          "install it with: pip install Pillow")
+
+
+def iter_frames(source: str) -> Iterator[Tuple[Image.Image, dict]]:
+    """Decode the frames of the image one at a time
+
+    :return: the frame converted to RGB or RGBA and the info of the frame
+    """
+    _require_pillow()
+
+    with Image.open(source) as image:
+        for index in range(getattr(image, 'n_frames', 1)):
+            image.seek(index)
+
+            info = dict(image.info)
+            if hasattr(image, 'tag_v2'):
+                info['tiff_tags'] = {tag: image.tag_v2[tag] for tag in TIFF_METADATA_TAGS
+                                     if tag in image.tag_v2}
+
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            yield image.convert('RGBA' if has_alpha else 'RGB'), info
+
+
+def enlarge_frame(thera, frame: Image.Image, interpolation: str, multiplier: int) -> Image.Image:
+    array = np.asarray(frame)
+    upscale = ((frame.width * multiplier, frame.height * multiplier), multiplier)
+
+    bgr = cv2.cvtColor(array[:, :, :3], cv2.COLOR_RGB2BGR)
+    bgr = thera.enlarge(bgr, upscale, interpolation)
+    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+    # super resolution only works on colour channels, so the transparency
+    # is always resized with a plain interpolation
+    if frame.mode == 'RGBA':
+        alpha = thera.bicula_scaling(np.ascontiguousarray(array[:, :, 3]), upscale, 'Bilinear')
+        return Image.fromarray(np.dstack((rgb, alpha)), 'RGBA')
+
+    return Image.fromarray(rgb, 'RGB')
+
+
+class _GifWriter:
+    """Encode the frames of a GIF one after the other
+
+    Pillow's GIF encoder keeps every frame in memory until the file is saved,
+    so the frames are encoded with its legacy getheader and getdata helpers
+    instead, each frame with its own colour table
+    """
+    # palette index reserved for the transparent pixels
+    TRANSPARENT_INDEX = 255
+
+    def __init__(self, filename: str, loop: Optional[int]):
+        self.__file = open(filename, 'wb')
+        self.__loop = loop
+        self.__header_written = False
+
+    def write(self, frame: Image.Image, info: dict) -> None:
+        params = {'duration': info.get('duration', 100), 'include_color_table': True}
+
+        if frame.mode == 'RGBA':
+            alpha = frame.getchannel('A')
+            frame = frame.convert('RGB').quantize(colors=255)
+
+            # pad the palette so that the reserved index is a valid colour
+            palette = frame.getpalette()[:765]
+            frame.putpalette(palette + [0] * (768 - len(palette)))
+            frame.paste(self.TRANSPARENT_INDEX, mask=alpha.point(lambda value: 255 if value < 128 else 0))
+
+            # the frames are whole composited images, the previous frame must
+            # not show through the transparent pixels
+            params.update(transparency=self.TRANSPARENT_INDEX, disposal=2)
+        else:
+            frame = frame.quantize()
+            params['disposal'] = 1
+
+        if not self.__header_written:
+            header_info = {'optimize': False}
+            if self.__loop is not None:
+                header_info['loop'] = self.__loop
+
+            header, _ = GifImagePlugin.getheader(frame, info=header_info)
+            for chunk in header:
+                self.__file.write(chunk)
+            self.__header_written = True
+
+        for chunk in GifImagePlugin.getdata(frame, **params):
+            self.__file.write(chunk)
+
+    def close(self) -> None:
+        # the GIF trailer
+        self.__file.write(b';')
+        self.__file.close()
+
+
+class _TiffWriter:
+    """Append the pages of a TIFF one after the other, the same way Pillow's
+    own multi-page TIFF encoder does"""
+    COMPRESSIONS = ('raw', 'packbits', 'tiff_lzw', 'tiff_deflate', 'tiff_adobe_deflate')
+
+    def __init__(self, filename: str):
+        self.__writer = TiffImagePlugin.AppendingTiffWriter(filename, new=True)
+
+    def write(self, frame: Image.Image, info: dict) -> None:
+        params = {'tiffinfo': info.get('tiff_tags', {})}
+        if 'dpi' in info:
+            params['dpi'] = info['dpi']
+        if info.get('compression') in self.COMPRESSIONS:
+            params['compression'] = info['compression']
+
+        frame.save(self.__writer, format='TIFF', **params)
+        self.__writer.newFrame()
+
+    def close(self) -> None:
+        self.__writer.close()
+
+
+class FrameStreamEnlarger:
+    """Enlarge every frame of an animation or page of a multi-page image
+
+    :param thera_factory: creates the _Thera instance of each worker, an
+        instance can't be shared between threads
+    :param workers: the number of frames enlarged at the same time, the
+        memory used grows with the workers and not with the frames
+    """
+    def __init__(self, thera_factory: Callable, workers: int = 1):
+        _require_pillow()
+        self.thera_factory = thera_factory
+        self.workers = max(1, workers)
+        self.__local = threading.local()
+
+    def _thera(self):
+        if not hasattr(self.__local, 'thera'):
+            self.__local.thera = self.thera_factory()
+        return self.__local.thera
+
+    def _enlarged_frames(self, source: str, interpolation: str,
+                         multiplier: int) -> Iterator[Tuple[Image.Image, dict]]:
+        def enlarge(frame):
+            return enlarge_frame(self._thera(), frame, interpolation, multiplier)
+
+        if self.workers == 1:
+            for frame, info in iter_frames(source):
+                yield enlarge(frame), info
+            return
+
+        # only a window of frames is in flight at any time, and the frames
+        # are handed back in their original order
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = deque()
+            for frame, info in iter_frames(source):
+                in_flight.append((executor.submit(enlarge, frame), info))
+
+                if len(in_flight) >= self.workers:
+                    future, info = in_flight.popleft()
+                    yield future.result(), info
+
+            while in_flight:
+                future, info = in_flight.popleft()
+                yield future.result(), info
+
+    def run(self, source: str, filename: str, interpolation: str, multiplier: int,
+            progress: Optional[Callable[[int], None]] = None) -> None:
+        """Enlarge the frames of source and encode them into filename
+
+        :param progress: called with the number of frames written so far
+        """
+        with Image.open(source) as image:
+            loop = image.info.get('loop')
+
+        partial = partial_path(filename)
+
+        if os.path.splitext(filename)[1][1:].lower() == 'gif':
+            writer = _GifWriter(partial, loop)
+        else:
+            writer = _TiffWriter(partial)
+
+        try:
+            for count, (frame, info) in enumerate(
+                    self._enlarged_frames(source, interpolation, multiplier), start=1):
+                writer.write(frame, info)
+                if progress is not None:
+                    progress(count)
+        except BaseException:
+            writer.close()
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        writer.close()
+        os.replace(partial, filename)
+
+
+if __name__ == '__main__':
+    from model import _Thera
+
+    parser = argparse.ArgumentParser(description="Enlarge every frame of an animated GIF or multi-page TIFF")
+    parser.add_argument('source')
+    parser.add_argument('filename')
+    parser.add_argument('--method', choices=('Bilinear', 'Cubic', 'Lanczos', 'Super Resolution'),
+                        default='Bilinear')
+    parser.add_argument('--scale', choices=('X2', 'X4', 'X8'), default='X2')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    FrameStreamEnlarger(_Thera, workers=args.workers).run(
+        args.source, args.filename, args.method, int(args.scale[1:]),
+        progress=lambda count: print(f"Enlarged {count} frames", end='\r'))
+    print(f"\nSaved to {args.filename}")
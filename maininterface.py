@@ -1,13 +1,16 @@
 
+import math
 import typing
+from collections import OrderedDict
 from PyQt6.QtWidgets import (QLabel, QPushButton, QMainWindow, QMenuBar,
                              QStatusBar, QDialog, QRadioButton, QGroupBox,
                              QHBoxLayout, QComboBox, QVBoxLayout,
-                             QSizePolicy, QDialogButtonBox, QLineEdit, QGridLayout)
-from PyQt6.QtCore import Qt, QSize, QObject, pyqtSignal
+                             QSizePolicy, QDialogButtonBox, QLineEdit, QGridLayout,
+                             QWidget)
+from PyQt6.QtCore import Qt, QSize, QObject, pyqtSignal, QPointF, QRectF
 from PyQt6.QtGui import (
     QFont, QAction, QIcon, QKeySequence, QResizeEvent, QKeyEvent, QPixmap,
-    QCloseEvent
+    QCloseEvent, QImage, QPainter, QColor, QWheelEvent, QMouseEvent, QPaintEvent
 )
 
 
@@ -18,6 +21,7 @@ class MiscellaneousEvent(QObject):
     interpolation_signal = pyqtSignal(str)
     enlargement_signal = pyqtSignal(str, tuple, str)
     enlargement_finished = pyqtSignal()
+    enlargement_failed = pyqtSignal(str)
 
 
 class MainInterface(QMainWindow):
@@ -68,6 +72,9 @@ class MainInterface(QMainWindow):
         self.action_image_enlargement = self.menu_tool.addAction("Increase image size")
         self.action_image_enlargement.setFont(self.main_font)
 
+        self.action_zoom_view = self.menu_tool.addAction("Zoom and pan")
+        self.action_zoom_view.setFont(self.main_font)
+
         self.action_about = self.create_actions("About", shortcut=QKeySequence.StandardKey.HelpContents)
 
         self.menu_bar.addAction(self.action_about)
@@ -89,7 +96,7 @@ class MainInterface(QMainWindow):
         self.image_container.setContextMenuPolicy(Qt.ContextMenuPolicy.ActionsContextMenu)
         self.image_container.addActions(
             [self.action_save, self.action_rename_image,
-             self.action_image_enlargement]
+             self.action_image_enlargement, self.action_zoom_view]
         )
 
     def resizeEvent(self, event: QResizeEvent) -> None:
@@ -141,6 +148,56 @@ class MainInterface(QMainWindow):
         ]
 
 
+class PreviewEvent(QObject):
+    crop_selected = pyqtSignal(int, int)
+    preview_ready = pyqtSignal(str, tuple, QImage)
+
+
+class CropSelector(QLabel):
+    """Thumbnail of the image, clicking on it picks the region to preview"""
+    def __init__(self, preview_event: PreviewEvent, parent=None):
+        super(CropSelector, self).__init__(parent)
+        self.preview_event = preview_event
+        self.setFixedSize(QSize(240, 180))
+        self.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.setCursor(Qt.CursorShape.CrossCursor)
+
+        # thumbnail pixels per image pixel and the position of the thumbnail in the label
+        self.__scale = None
+        self.__origin = QPointF(0, 0)
+
+        # the region of the image being previewed
+        self.__crop = None
+
+    def set_image(self, image: QImage) -> None:
+        thumbnail = image.scaled(self.size(), aspectRatioMode=Qt.AspectRatioMode.KeepAspectRatio,
+                                 transformMode=Qt.TransformationMode.SmoothTransformation)
+        self.setPixmap(QPixmap.fromImage(thumbnail))
+
+        self.__scale = thumbnail.width() / image.width()
+        self.__origin = QPointF((self.width() - thumbnail.width()) / 2,
+                                (self.height() - thumbnail.height()) / 2)
+
+    def set_crop(self, x, y, width, height) -> None:
+        self.__crop = QRectF(x, y, width, height)
+        self.update()
+
+    def mousePressEvent(self, event: QMouseEvent) -> None:
+        if self.__scale:
+            point = (event.position() - self.__origin) / self.__scale
+            self.preview_event.crop_selected.emit(int(point.x()), int(point.y()))
+
+    def paintEvent(self, event: QPaintEvent) -> None:
+        super(CropSelector, self).paintEvent(event)
+
+        if self.__crop is not None and self.__scale:
+            painter = QPainter(self)
+            painter.setPen(QColor("red"))
+            painter.drawRect(QRectF(self.__origin + self.__crop.topLeft() * self.__scale,
+                                    self.__crop.size() * self.__scale))
+            painter.end()
+
+
 class EnlargeImageInterface(QDialog):
     def __init__(self, parent=None):
         super(EnlargeImageInterface, self).__init__(parent=parent)
@@ -192,6 +249,14 @@ class EnlargeImageInterface(QDialog):
         self.use_super_resolution.clicked.connect(
             lambda: self.super_resolution_warning_display.setHidden(False))
 
+        # the preview of the chosen method is outlined
+        self.method_buttons = {
+            button.text(): button
+            for button in (self.use_bilinear, self.use_cubic, self.use_lanczos, self.use_super_resolution)
+        }
+        for method_button in self.method_buttons.values():
+            method_button.toggled.connect(self.highlight_preview)
+
         ######################################################
 
         self.enlargement_level = QComboBox()
@@ -233,6 +298,39 @@ class EnlargeImageInterface(QDialog):
 
         ############################################################
 
+        # preview a small region of the image enlarged with every method at 100%
+        self.preview_event = PreviewEvent()
+        self.group_preview = QGroupBox("Preview", self)
+
+        self.crop_selector = CropSelector(self.preview_event, self.group_preview)
+        crop_hint = QLabel("Click on the image to choose the region to preview")
+        crop_hint.setWordWrap(True)
+        crop_hint.setMaximumWidth(240)
+
+        crop_layout = QVBoxLayout()
+        crop_layout.addWidget(self.crop_selector)
+        crop_layout.addWidget(crop_hint)
+        crop_layout.addStretch()
+
+        self.preview_displays = {}
+        previews_layout = QGridLayout()
+        for index, method in enumerate(("Bilinear", "Cubic", "Lanczos", "Super Resolution")):
+            display = QLabel("Loading...")
+            display.setFixedSize(QSize(260, 260))
+            display.setAlignment(Qt.AlignmentFlag.AlignCenter)
+            self.preview_displays[method] = display
+
+            row, col = divmod(index, 2)
+            previews_layout.addWidget(QLabel(method), row * 2, col)
+            previews_layout.addWidget(display, row * 2 + 1, col)
+
+        layout_5 = QHBoxLayout()
+        layout_5.addLayout(crop_layout)
+        layout_5.addLayout(previews_layout)
+        self.group_preview.setLayout(layout_5)
+
+        ############################################################
+
         self.button_box = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
         self.button_box.accepted.connect(self.accept)
         self.button_box.rejected.connect(self.reject)
@@ -243,10 +341,264 @@ class EnlargeImageInterface(QDialog):
         layout.addLayout(layout_2)
         layout.addLayout(layout_3)
         layout.addLayout(layout_4)
+        layout.addWidget(self.group_preview)
         layout.addWidget(self.button_box)
 
         self.setLayout(layout)
 
+    def highlight_preview(self) -> None:
+        for method, display in self.preview_displays.items():
+            selected = self.method_buttons[method].isChecked()
+            display.setStyleSheet("border: 2px solid #3daee9;" if selected else "")
+
+
+class TileEvent(QObject):
+    tiles_needed = pyqtSignal(list)
+    tile_loaded = pyqtSignal(int, int, int, QImage)
+    pyramid_progress = pyqtSignal(int, int)
+    pyramid_ready = pyqtSignal(bool)
+    zoom_changed = pyqtSignal(float)
+
+
+class TiledImageView(QWidget):
+    """Display an image from its tile pyramid
+
+    Scroll to zoom around the mouse, drag to pan and double click to switch
+    between 100% and fitting the window. Only the tiles on screen are asked
+    for, and the least recently drawn tiles are dropped from memory
+    """
+    MAX_ZOOM = 8.0
+
+    # about 100MB of decoded 256 x 256 tiles, the cache grows to twice the
+    # tiles on screen on views large enough to show more than half of that
+    MIN_CACHED_TILES = 400
+
+    def __init__(self, parent=None):
+        super(TiledImageView, self).__init__(parent)
+        self.tile_event = TileEvent()
+        self.tile_event.tile_loaded.connect(self.add_tile)
+
+        # the size of every level of the pyramid, level 0 being the full image
+        self.levels = []
+        self.tile_size = 256
+
+        # screen pixels per full size image pixel
+        self.zoom = 1.0
+        # the full size image pixel shown at the top left corner of the view
+        self.offset = QPointF(0, 0)
+        self.fitted = True
+
+        self.__tiles = OrderedDict()
+        self.__max_tiles = self.MIN_CACHED_TILES
+        self.__requested = set()
+        self.__drag_start = None
+        self.__drag_offset = None
+
+        self.setMinimumSize(QSize(400, 300))
+
+    def set_pyramid(self, levels, tile_size) -> None:
+        self.levels = levels
+        self.tile_size = tile_size
+        self.__tiles.clear()
+        self.__requested.clear()
+        self.fit_to_window()
+
+    def add_tile(self, level, row, col, image: QImage) -> None:
+        key = (level, row, col)
+        self.__requested.discard(key)
+        self.__tiles[key] = image
+        self.__tiles.move_to_end(key)
+
+        while len(self.__tiles) > self.__max_tiles:
+            self.__tiles.popitem(last=False)
+
+        self.update()
+
+    def fit_zoom(self) -> float:
+        width, height = self.levels[0]
+        return min(self.width() / width, self.height() / height)
+
+    def fit_to_window(self) -> None:
+        if not self.levels:
+            return
+
+        self.zoom = self.fit_zoom()
+        self.fitted = True
+        self.clamp_offset()
+        self.tile_event.zoom_changed.emit(self.zoom)
+        self.update()
+
+    def zoom_at(self, factor, anchor: QPointF) -> None:
+        """Zoom by factor keeping the image pixel under anchor in place"""
+        if not self.levels:
+            return
+
+        image_point = self.offset + anchor / self.zoom
+        self.zoom = min(max(self.zoom * factor, self.fit_zoom() / 2), self.MAX_ZOOM)
+        self.offset = image_point - anchor / self.zoom
+        self.fitted = False
+        self.clamp_offset()
+        self.tile_event.zoom_changed.emit(self.zoom)
+        self.update()
+
+    def clamp_offset(self) -> None:
+        """Keep the image on screen, centring it along the sides where it
+        is smaller than the view"""
+        width, height = self.levels[0]
+        view_width, view_height = self.width() / self.zoom, self.height() / self.zoom
+
+        x = (width - view_width) / 2 if view_width >= width else \
+            min(max(self.offset.x(), 0), width - view_width)
+        y = (height - view_height) / 2 if view_height >= height else \
+            min(max(self.offset.y(), 0), height - view_height)
+        self.offset = QPointF(x, y)
+
+    def current_level(self) -> int:
+        """The smallest level that still has at least one pixel per screen pixel"""
+        if self.zoom >= 1:
+            return 0
+        return min(int(math.log2(1 / self.zoom)), len(self.levels) - 1)
+
+    def paintEvent(self, event: QPaintEvent) -> None:
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor("#202020"))
+
+        if not self.levels:
+            painter.end()
+            return
+
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, self.zoom < 1)
+
+        level = self.current_level()
+        level_width, level_height = self.levels[level]
+
+        # full size image pixels per pixel of the level
+        factor_x = self.levels[0][0] / level_width
+        factor_y = self.levels[0][1] / level_height
+        tile_size = self.tile_size
+
+        view_right = self.offset.x() + self.width() / self.zoom
+        view_bottom = self.offset.y() + self.height() / self.zoom
+
+        first_col = max(int(self.offset.x() / factor_x // tile_size), 0)
+        first_row = max(int(self.offset.y() / factor_y // tile_size), 0)
+        last_col = min(int(view_right / factor_x // tile_size), -(-level_width // tile_size) - 1)
+        last_row = min(int(view_bottom / factor_y // tile_size), -(-level_height // tile_size) - 1)
+
+        # the tiles on screen must never evict each other
+        visible = (last_row - first_row + 1) * (last_col - first_col + 1)
+        self.__max_tiles = max(self.MIN_CACHED_TILES, 2 * visible)
+
+        missing = []
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                left = (col * tile_size * factor_x - self.offset.x()) * self.zoom
+                top = (row * tile_size * factor_y - self.offset.y()) * self.zoom
+                scale_x, scale_y = factor_x * self.zoom, factor_y * self.zoom
+
+                key = (level, row, col)
+                tile = self.__tiles.get(key)
+                if tile is not None:
+                    self.__tiles.move_to_end(key)
+                    painter.drawImage(QRectF(left, top, tile.width() * scale_x, tile.height() * scale_y), tile)
+                else:
+                    missing.append(key)
+                    self.draw_from_coarser_level(
+                        painter, key, QRectF(left, top, tile_size * scale_x, tile_size * scale_y))
+
+        painter.end()
+
+        # the tiles asked for earlier that are not on screen anymore are dropped
+        if missing and not set(missing) <= self.__requested:
+            self.__requested = set(missing)
+            self.tile_event.tiles_needed.emit(missing)
+
+    def draw_from_coarser_level(self, painter: QPainter, key, target: QRectF) -> None:
+        """Stand in for a tile that is still loading with the part of a
+        coarser tile covering the same area"""
+        level, row, col = key
+
+        for coarser in range(level + 1, len(self.levels)):
+            shift = coarser - level
+            tile = self.__tiles.get((coarser, row >> shift, col >> shift))
+            if tile is None:
+                continue
+
+            size = self.tile_size / 2 ** shift
+            source = QRectF((col - (col >> shift << shift)) * size,
+                            (row - (row >> shift << shift)) * size, size, size)
+            clipped = source.intersected(QRectF(tile.rect()))
+            if clipped.isEmpty():
+                return
+
+            scale = target.width() / size
+            painter.drawImage(QRectF(target.x() + (clipped.x() - source.x()) * scale,
+                                     target.y() + (clipped.y() - source.y()) * scale,
+                                     clipped.width() * scale, clipped.height() * scale),
+                              tile, clipped)
+            return
+
+    def wheelEvent(self, event: QWheelEvent) -> None:
+        self.zoom_at(1.25 if event.angleDelta().y() > 0 else 0.8, event.position())
+
+    def mousePressEvent(self, event: QMouseEvent) -> None:
+        if event.button() == Qt.MouseButton.LeftButton:
+            self.__drag_start = event.position()
+            self.__drag_offset = self.offset
+            self.setCursor(Qt.CursorShape.ClosedHandCursor)
+
+    def mouseMoveEvent(self, event: QMouseEvent) -> None:
+        if self.__drag_start is not None and self.levels:
+            self.offset = self.__drag_offset - (event.position() - self.__drag_start) / self.zoom
+            self.clamp_offset()
+            self.update()
+
+    def mouseReleaseEvent(self, event: QMouseEvent) -> None:
+        self.__drag_start = None
+        self.unsetCursor()
+
+    def mouseDoubleClickEvent(self, event: QMouseEvent) -> None:
+        if self.fitted and self.levels:
+            self.zoom_at(1 / self.zoom, event.position())
+        else:
+            self.fit_to_window()
+
+    def resizeEvent(self, event: QResizeEvent) -> None:
+        if not self.levels:
+            return
+
+        if self.fitted:
+            self.fit_to_window()
+        else:
+            self.clamp_offset()
+
+
+class ZoomViewInterface(QDialog):
+    def __init__(self, parent=None):
+        super(ZoomViewInterface, self).__init__(parent=parent)
+        self.parent = parent
+
+        self.setWindowTitle("Zoom and pan")
+        self.resize(QSize(1000, 750))
+
+        # the decoded tiles are freed as soon as the dialog is closed
+        self.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+
+        self.image_view = TiledImageView(self)
+        self.status_display = QLabel("Preparing the image, please wait...")
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.image_view, 1)
+        layout.addWidget(self.status_display)
+        self.setLayout(layout)
+
+        self.image_view.tile_event.pyramid_progress.connect(
+            lambda level, total: self.status_display.setText(
+                f"Preparing the image, please wait... {level} / {total}"))
+        self.image_view.tile_event.zoom_changed.connect(
+            lambda zoom: self.status_display.setText(
+                f"{zoom:.0%}    Scroll to zoom, drag to pan, double click to switch between 100% and fit"))
+
 
 class AboutInterface(QDialog):
     def __init__(self):
@@ -1,14 +1,20 @@
 
 import os
 import cv2
+import json
 import shutil
 import numpy as np
+from collections import OrderedDict
 from typing import Tuple, NewType, Callable
 from PyQt6.QtWidgets import QFileDialog, QInputDialog, QMessageBox
 from PyQt6.QtGui import QImage, QPixmap
 from PyQt6.QtCore import Qt, QRunnable, QThreadPool
 from cv2 import dnn_superres
 
+from checkpoint import CheckpointedJob, CHECKPOINT_MIN_PIXELS, atomic_imwrite
+from frames import FrameStreamEnlarger, supports_frame_streaming
+from pyramid import TilePyramid
+
 
 class Worker(QRunnable):
     def __init__(self, func: Callable, params: dict):
@@ -30,15 +36,55 @@ Scale = Tuple[Width, Height]
 Upscale = Tuple[Scale, Multiplier]
 
 
+def get_upscale(image: np.ndarray, multiplier: int) -> Upscale:
+    """Build the upscale param expected by _Thera from the size of an image
+    read with cv2 and the scale multiplier
+    """
+    height, width = image.shape[:2]
+    return (Width(width * multiplier), Height(height * multiplier)), Multiplier(multiplier)
+
+
+# resolve the bundled models relative to this file, so that Thera also
+# works when it is driven from outside the app directory
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+MODEL_PATHS = {
+    2: os.path.join(MODELS_DIR, "LapSRN_x2.pb"),
+    4: os.path.join(MODELS_DIR, "LapSRN_x4.pb"),
+    8: os.path.join(MODELS_DIR, "LapSRN_x8.pb")
+}
+
+# the DNN backend, target and thread count tuned for this machine by autotune.py
+DNN_PROFILE_PATH = os.path.join(MODELS_DIR, "dnn_profile.json")
+
+# the number of threads OpenCV picked, used for the scales that were not tuned
+DEFAULT_NUM_THREADS = cv2.getNumThreads()
+
+
+def load_dnn_profile(path: str = DNN_PROFILE_PATH) -> dict:
+    """Read the DNN configuration per scale multiplier saved by autotune.py
+
+    An empty dict is returned when the machine has not been tuned, in which
+    case OpenCV keeps its defaults
+    """
+    try:
+        with open(path) as profile_file:
+            profile = json.load(profile_file)
+    except (OSError, ValueError):
+        return {}
+
+    return {int(multiplier): config for multiplier, config in profile.get('scales', {}).items()}
+
+
 class _Thera:
     def __init__(self):
         print("Wake up Thera")
-        self.__model_paths = {
-            2: "models/lapSRN_x2.pb",
-            4: "models/lapSRN_x4.pb",
-            8: "models/lapSRN_x8.pb"
-        }
+        self.__model_paths = MODEL_PATHS
         self.__sr = dnn_superres.DnnSuperResImpl_create()
+        self.__dnn_profile = load_dnn_profile()
+
+        # the multiplier of the model currently loaded in self.__sr, reading
+        # the model again for every image is wasteful when enlarging in bulk
+        self.__loaded_multiplier = None
 
     def bicula_scaling(self, image: np.ndarray,
                        upscale: Upscale, interpolation: str) -> np.ndarray:
@@ -62,15 +108,44 @@ class _Thera:
 
     def super_resolution(self, image: np.ndarray, upscale: Upscale) -> np.ndarray:
         multiplier = upscale[1]
-        model_path = self.__model_paths[multiplier]
-        self.__sr.readModel(model_path)
-        self.__sr.setModel('lapsrn', 2)
+        if self.__loaded_multiplier != multiplier:
+            model_path = self.__model_paths[multiplier]
+            self.__sr.readModel(model_path)
+            self.__sr.setModel('lapsrn', multiplier)
+            self.__loaded_multiplier = multiplier
+
+            # the preferable backend and target only apply to the network
+            # that was just read, so they are set again with every model
+            config = self.__dnn_profile.get(multiplier)
+            if config:
+                self.__sr.setPreferableBackend(config['backend'])
+                self.__sr.setPreferableTarget(config['target'])
+
+        # the number of threads is shared by the whole process, another _Thera
+        # may have changed it for another scale since the model was read
+        config = self.__dnn_profile.get(multiplier)
+        cv2.setNumThreads(config['threads'] if config else DEFAULT_NUM_THREADS)
 
         result = self.__sr.upsample(image)
         return result
 
+    def enlarge(self, image: np.ndarray, upscale: Upscale, interpolation: str) -> np.ndarray:
+        """Enlarge the image with any of the methods offered in the enlargement dialog
+
+        :param image: the image as read by cv2.imread
+        :param upscale: the final image size and the scale multiplier
+        :param interpolation: Bilinear, Cubic, Lanczos or Super Resolution
+        :return: the enlarged image
+        """
+        if interpolation == 'Super Resolution':
+            return self.super_resolution(image, upscale)
+        return self.bicula_scaling(image, upscale, interpolation)
+
     def save_enlarged_image(self, image: np.ndarray, filename) -> None:
-        cv2.imwrite(filename, image)
+        # cv2.imwrite reports a failed write, e.g. to a missing folder, by
+        # returning False rather than raising
+        if not atomic_imwrite(filename, image):
+            raise OSError(f"Could not write the image to {filename}")
 
 
 class _ImageInterfaceControls:
@@ -255,10 +330,25 @@ class _ImageInterfaceControls:
 
 
 class _EnlargementDialogControls:
+    # side of the enlarged region shown at 100% for every method
+    PREVIEW_SIZE = 256
+    MAX_CACHED_PREVIEWS = 64
+
     def __init__(self):
         self.scale_converter = {'X2': 2, 'X4': 4, 'X8': 8}
         self.current_img_in_view = None
 
+        # the previews are kept by (image, crop, method, scale), so that going
+        # back to a region or scale that was already previewed is instant
+        self.preview_cache = OrderedDict()
+        self.crop_centre = None
+        self.__current_preview = None
+
+        # a single thread, so that the previews can share one _Thera
+        self.__thera = _Thera()
+        self.__preview_threadpool = QThreadPool()
+        self.__preview_threadpool.setMaxThreadCount(1)
+
     def open_dialog(self, dialog):
         method = None
         filename = None
@@ -272,6 +362,20 @@ class _EnlargementDialogControls:
         dialog.save_to_button.clicked.connect(
             lambda: self.open_save_to_dialog(dialog))
 
+        # a corrupted image can't be previewed
+        if self.image.width() > 0 and self.image.height() > 0:
+            self.crop_centre = (self.image.width() // 2, self.image.height() // 2)
+            dialog.crop_selector.set_image(self.image)
+
+            dialog.preview_event.crop_selected.connect(
+                lambda x, y: self.select_preview_crop(dialog, x, y))
+            dialog.preview_event.preview_ready.connect(
+                lambda method, key, preview: self.display_preview(dialog, method, key, preview))
+            dialog.enlargement_level.currentTextChanged.connect(
+                lambda: self.update_previews(dialog))
+
+            self.update_previews(dialog)
+
         if dialog.exec():
             filename = dialog.save_to_display.text().strip()
             self.new_filename = filename
@@ -317,6 +421,81 @@ class _EnlargementDialogControls:
             dialog.initial_size_display.setText(initial_size)
             dialog.final_size_display.setText(final_size)
 
+    def preview_crop(self, scale_by) -> Tuple[int, int, int, int]:
+        """The region around crop_centre that fills a preview once enlarged"""
+        size = self.PREVIEW_SIZE // scale_by
+        width, height = min(size, self.image.width()), min(size, self.image.height())
+
+        x = min(max(self.crop_centre[0] - width // 2, 0), self.image.width() - width)
+        y = min(max(self.crop_centre[1] - height // 2, 0), self.image.height() - height)
+        return x, y, width, height
+
+    def select_preview_crop(self, dialog, x, y):
+        self.crop_centre = (x, y)
+        self.update_previews(dialog)
+
+    def update_previews(self, dialog):
+        scale_by = self.scale_converter[dialog.enlargement_level.currentText()]
+        crop = self.preview_crop(scale_by)
+        dialog.crop_selector.set_crop(*crop)
+        self.__current_preview = (self.current_img_in_view, crop, scale_by)
+
+        # the previews still waiting for the previous region are not needed anymore
+        self.__preview_threadpool.clear()
+
+        region = None
+        for method, display in dialog.preview_displays.items():
+            key = (self.current_img_in_view, crop, method, scale_by)
+
+            if key in self.preview_cache:
+                self.preview_cache.move_to_end(key)
+                display.setPixmap(QPixmap.fromImage(self.preview_cache[key]))
+                continue
+
+            display.setText("Loading...")
+            if region is None:
+                region = self.__crop_image(crop)
+
+            params = {'dialog': dialog, 'method': method, 'key': key,
+                      'region': region, 'scale_by': scale_by}
+            self.__preview_threadpool.start(Worker(self.__enlarge_preview, params=params))
+
+    def __crop_image(self, crop) -> np.ndarray:
+        """Copy the region of the displayed image into an array _Thera can enlarge"""
+        region = self.image.copy(*crop).convertToFormat(QImage.Format.Format_RGB888)
+
+        bits = region.constBits()
+        bits.setsize(region.sizeInBytes())
+
+        # every line of a QImage is padded to a multiple of 4 bytes
+        array = np.frombuffer(bits, np.uint8).reshape(region.height(), region.bytesPerLine())
+        array = array[:, :region.width() * 3].reshape(region.height(), region.width(), 3)
+        return cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
+
+    def __enlarge_preview(self, dialog, method, key, region, scale_by):
+        try:
+            enlarged = self.__thera.enlarge(region, get_upscale(region, scale_by), method)
+        except cv2.error as e:
+            print("Error: ", e.msg)
+            return
+
+        enlarged = np.ascontiguousarray(cv2.cvtColor(enlarged, cv2.COLOR_BGR2RGB))
+        height, width = enlarged.shape[:2]
+
+        # copy, so that the QImage does not point into the array once it is gone
+        preview = QImage(enlarged.data, width, height, enlarged.strides[0], QImage.Format.Format_RGB888).copy()
+        dialog.preview_event.preview_ready.emit(method, key, preview)
+
+    def display_preview(self, dialog, method, key, preview):
+        self.preview_cache[key] = preview
+        while len(self.preview_cache) > self.MAX_CACHED_PREVIEWS:
+            self.preview_cache.popitem(last=False)
+
+        # the previews of a region or scale no longer selected are only cached
+        image, crop, _, scale_by = key
+        if (image, crop, scale_by) == self.__current_preview:
+            dialog.preview_displays[method].setPixmap(QPixmap.fromImage(preview))
+
     @staticmethod
     def open_save_to_dialog(dialog) -> str:
         filename = QFileDialog().getSaveFileName(dialog, "Save image as", ".",
@@ -333,10 +512,83 @@ class _EnlargementDialogControls:
             return filename
 
 
+class _ZoomViewControls:
+    """The pyramid and tile loaders of one zoom view dialog, every open dialog
+    has its own so that they don't load tiles of each other's image"""
+    def __init__(self, filename):
+        self.pyramid = TilePyramid(filename)
+
+        # the tiles are read from the disk in the background, so that
+        # panning never waits on them
+        self.__threadpool = QThreadPool()
+        self.__threadpool.setMaxThreadCount(4)
+        self.__tile_event = None
+
+    def open_dialog(self, dialog):
+        # the workers only hold on to the tile event, which outlives the dialog
+        self.__tile_event = tile_event = dialog.image_view.tile_event
+
+        tile_event.tiles_needed.connect(lambda tiles: self.load_tiles(tiles))
+        tile_event.pyramid_ready.connect(lambda success: self.display_pyramid(dialog, success))
+
+        dialog.show()
+
+        if self.pyramid.is_built():
+            self.display_pyramid(dialog, True)
+        else:
+            # the pyramid is only built the first time the image is zoomed
+            # into. It goes on the global pool, the build is kept in the cache
+            # even when the dialog is closed before it is done
+            worker = Worker(self.__build_pyramid, params={'tile_event': tile_event, 'pyramid': self.pyramid})
+            QThreadPool.globalInstance().start(worker)
+
+    def close(self):
+        """Drop the tiles still queued and stop the workers still running
+        from reaching the closed dialog"""
+        self.__threadpool.clear()
+
+        for signal in (self.__tile_event.tiles_needed, self.__tile_event.tile_loaded,
+                       self.__tile_event.pyramid_progress, self.__tile_event.pyramid_ready,
+                       self.__tile_event.zoom_changed):
+            try:
+                signal.disconnect()
+            except TypeError:
+                # nothing was connected to it
+                pass
+
+    def display_pyramid(self, dialog, success):
+        if success:
+            dialog.image_view.set_pyramid(self.pyramid.levels, self.pyramid.tile_size)
+        else:
+            dialog.status_display.setText("This image is corrupted, or its tiles could not be saved")
+
+    @staticmethod
+    def __build_pyramid(tile_event, pyramid):
+        success = pyramid.build(progress=lambda level, total: tile_event.pyramid_progress.emit(level, total))
+        tile_event.pyramid_ready.emit(success)
+
+    def load_tiles(self, tiles):
+        # the tiles asked for earlier and not loading yet went off screen
+        self.__threadpool.clear()
+
+        for level, row, col in tiles:
+            params = {'tile_event': self.__tile_event, 'path': self.pyramid.tile_path(level, row, col),
+                      'key': (level, row, col)}
+            self.__threadpool.start(Worker(self.__load_tile, params=params))
+
+    @staticmethod
+    def __load_tile(tile_event, path, key):
+        # QImage, unlike QPixmap, can be created outside the GUI thread
+        image = QImage(path)
+        if not image.isNull():
+            tile_event.tile_loaded.emit(*key, image)
+
+
 class Model:
     def __init__(self):
         self.__image_controls = _ImageInterfaceControls()
         self._enlargement_dialog_control = _EnlargementDialogControls()
+        self.__zoom_view_controls = {}
         self.__thera = _Thera()
 
         # controls when to turn off the application
@@ -350,10 +602,12 @@ class Model:
             view.action_rename_image.setDisabled(True)
             view.action_save.setDisabled(True)
             view.action_image_enlargement.setDisabled(True)
+            view.action_zoom_view.setDisabled(True)
         else:
             view.action_save.setDisabled(False)
             view.action_rename_image.setDisabled(False)
             view.action_image_enlargement.setDisabled(False)
+            view.action_zoom_view.setDisabled(False)
 
     def open_image(self, view):
         self.__image_controls.open_image(view)
@@ -399,24 +653,59 @@ class Model:
         self._enlargement_dialog_control.open_dialog(enlargement_dialog)
 
     def __enlarge_image(self, view, interpolation=None, upscale: Upscale = None, filename=None):
-        image = cv2.imread(self.__image_controls.current_img_in_view)
+        source = self.__image_controls.current_img_in_view
         view.status_bar.showMessage("Please wait, enlarging image...", 0)
 
-        if interpolation != 'Super Resolution':
-            image = self.__thera.bicula_scaling(image, upscale, interpolation)
-        else:
+        # cv2 only reads the first frame of animations and multi-page images,
+        # their frames are enlarged one at a time instead
+        if supports_frame_streaming(source, filename):
             try:
-                image = self.__thera.super_resolution(image, upscale)
-            except cv2.error as e:
-                print("Error: ", e.msg)
+                FrameStreamEnlarger(lambda: self.__thera).run(
+                    source, filename, interpolation, upscale[1],
+                    progress=lambda count: view.status_bar.showMessage(
+                        f"Please wait, enlarging image... {count} frames", 0))
+            except (cv2.error, ImportError, OSError) as e:
+                self.__enlargement_failed(view, e)
+                return
+
+            view.status_bar.showMessage("Finished", 5000)
+            view.miscellaneous_event.enlargement_finished.emit()
+            return
 
-                # QMessageBox.warning(view, "Error", e.msg)
+        try:
+            image = cv2.imread(source)
+            if image is None:
+                raise OSError("This image is corrupted")
+
+            # long super resolution jobs save their progress as they go,
+            # so they can be resumed if the app is killed midway
+            if interpolation == 'Super Resolution' and \
+                    image.shape[0] * image.shape[1] >= CHECKPOINT_MIN_PIXELS:
+                job = CheckpointedJob(source, filename, interpolation, upscale[1])
+                saved = job.run(self.__thera, image, progress=lambda finished, total: view.status_bar.showMessage(
+                    f"Please wait, enlarging image... {finished} / {total} tiles", 0))
+                if not saved:
+                    raise OSError(f"Could not write the image to {filename}")
+            else:
+                image = self.__thera.enlarge(image, upscale, interpolation)
+                self.__thera.save_enlarged_image(image, filename)
+        except (cv2.error, OSError) as e:
+            self.__enlargement_failed(view, e)
+            return
 
-        self.__thera.save_enlarged_image(image, filename)
         view.status_bar.showMessage("Finished", 5000)
 
         view.miscellaneous_event.enlargement_finished.emit()
 
+    @staticmethod
+    def __enlargement_failed(view, error):
+        # cv2.error keeps the readable part of its message in msg
+        message = getattr(error, 'msg', None) or str(error)
+        print("Error: ", message)
+
+        view.status_bar.showMessage("Failed", 5000)
+        view.miscellaneous_event.enlargement_failed.emit(message)
+
     def enlarge_image(self, view, interpolation=None, upscale=None, filename=None):
         params = {
             'view': view, 'interpolation': interpolation,
@@ -430,6 +719,25 @@ class Model:
 
         QMessageBox().information(view, "Success", text)
 
+    @staticmethod
+    def end_of_enlargement_error(view, message):
+        QMessageBox().warning(view, "Error", f"The image could not be enlarged:\n{message}")
+
+    def open_zoom_view(self, zoom_dialog):
+        self.zoom_dialog = zoom_dialog
+
+        controls = _ZoomViewControls(self.__image_controls.current_img_in_view)
+        self.__zoom_view_controls[zoom_dialog] = controls
+        controls.open_dialog(zoom_dialog)
+
+        # the dialog deletes itself once closed, its tiles go with it
+        zoom_dialog.finished.connect(lambda result: self.close_zoom_view(zoom_dialog))
+
+    def close_zoom_view(self, zoom_dialog):
+        controls = self.__zoom_view_controls.pop(zoom_dialog, None)
+        if controls is not None:
+            controls.close()
+
     def open_about_dialog(self, about_dialog):
         self.about_dialog = about_dialog
         self.about_dialog.show()
@@ -0,0 +1,196 @@
+"""Tile pyramid
+
+The enlarged images can be far too large to decode every time they are
+viewed, so they are cut once into a multi-resolution pyramid of small tiles
+cached on disk. Level 0 is the image at full size and every level above it
+is half the size of the one below, down to a level that fits in one tile.
+The viewer then only loads the tiles of the level and region on screen.
+
+"""
+
+import os
+import json
+import math
+import time
+import shutil
+import hashlib
+from typing import Callable, List, Optional, Tuple
+
+import cv2
+
+
+TILE_SIZE = 256
+
+# the tiles are only used for viewing, JPEG keeps the cache small and the
+# pyramid quick to build
+TILE_FORMAT = '.jpg'
+
+DEFAULT_CACHE_ROOT = os.path.join(os.path.expanduser('~'), '.thera', 'pyramids')
+
+# the least recently viewed pyramids are removed once the cache grows past this
+DEFAULT_CACHE_LIMIT = 2 * 1024 ** 3
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _cache_key(source: str, tile_size: int) -> str:
+    stat = os.stat(source)
+    key = json.dumps([source, stat.st_size, stat.st_mtime, tile_size])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def prune_cache(cache_root: str = None, limit: int = DEFAULT_CACHE_LIMIT, keep: str = None) -> None:
+    """Remove the stale pyramids and the least recently viewed ones until the
+    cache fits in limit bytes
+
+    A pyramid is stale when the image it was cut from has changed or is gone.
+    The modification time of a manifest is refreshed every time its pyramid
+    is opened, so it tells when the pyramid was last viewed.
+
+    :param keep: the cache folder of the pyramid being viewed, never removed
+    """
+    cache_root = cache_root or DEFAULT_CACHE_ROOT
+    if not os.path.isdir(cache_root):
+        return
+
+    pyramids = []
+    for entry in os.scandir(cache_root):
+        if not entry.is_dir() or entry.path == keep:
+            continue
+
+        manifest_path = os.path.join(entry.path, MANIFEST_NAME)
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            last_viewed = os.path.getmtime(manifest_path)
+        except (OSError, ValueError):
+            # a build that was interrupted, or is running right now in an
+            # other window, is left to finish unless it is a day old
+            try:
+                if os.path.getmtime(entry.path) < time.time() - 24 * 60 * 60:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+            continue
+
+        try:
+            stale = _cache_key(manifest['source'], manifest['tile_size']) != entry.name
+        except OSError:
+            stale = True
+
+        if stale:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            pyramids.append((last_viewed, entry.path))
+
+    total = _directory_size(keep) if keep else 0
+    sizes = {path: _directory_size(path) for _, path in pyramids}
+    total += sum(sizes.values())
+
+    # the most recently viewed pyramids are kept
+    for _, path in sorted(pyramids):
+        if total <= limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= sizes[path]
+
+
+class TilePyramid:
+    """Multi-resolution tile pyramid of an image, cached on disk
+
+    The cache of an image is identified by its path, size and modification
+    time, so an image that is overwritten gets a fresh pyramid
+    """
+    def __init__(self, source: str, cache_root: str = None, tile_size: int = TILE_SIZE):
+        self.source = os.path.abspath(source)
+        self.tile_size = tile_size
+        self.cache_root = cache_root or DEFAULT_CACHE_ROOT
+
+        self.cache_dir = os.path.join(self.cache_root, _cache_key(self.source, tile_size))
+        self.__manifest_path = os.path.join(self.cache_dir, MANIFEST_NAME)
+
+        # the size of every level, filled once the pyramid is built
+        self.levels: List[Tuple[int, int]] = []
+        if os.path.exists(self.__manifest_path):
+            self._read_manifest()
+
+            # mark the pyramid as recently viewed, for prune_cache
+            os.utime(self.__manifest_path)
+
+    @property
+    def width(self) -> int:
+        return self.levels[0][0]
+
+    @property
+    def height(self) -> int:
+        return self.levels[0][1]
+
+    def is_built(self) -> bool:
+        return bool(self.levels)
+
+    def _read_manifest(self) -> None:
+        with open(self.__manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.levels = [tuple(level) for level in manifest['levels']]
+
+    def tile_path(self, level: int, row: int, col: int) -> str:
+        return os.path.join(self.cache_dir, str(level), f"{row}_{col}{TILE_FORMAT}")
+
+    def build(self, progress: Optional[Callable[[int, int], None]] = None) -> bool:
+        """Decode the image once and write the tiles of every level
+
+        The full image is released as soon as the first half size level is
+        made. The manifest is written last, so an interrupted build is
+        started over. The cache is pruned once the pyramid is complete.
+
+        :param progress: called with the level finished and the number of levels
+        :return: whether the image could be decoded and every tile was saved
+        """
+        image = cv2.imread(self.source)
+        if image is None:
+            return False
+
+        height, width = image.shape[:2]
+        level_count = max(1, math.ceil(math.log2(max(width, height) / self.tile_size)) + 1)
+        levels = []
+
+        for level in range(level_count):
+            if level:
+                width, height = max(1, (width + 1) // 2), max(1, (height + 1) // 2)
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+            levels.append((width, height))
+
+            os.makedirs(os.path.join(self.cache_dir, str(level)), exist_ok=True)
+            for row in range(-(-height // self.tile_size)):
+                for col in range(-(-width // self.tile_size)):
+                    top, left = row * self.tile_size, col * self.tile_size
+                    tile = image[top:top + self.tile_size, left:left + self.tile_size]
+                    # a tile that is not saved would be missing for good once
+                    # the manifest marks the pyramid as built
+                    if not cv2.imwrite(self.tile_path(level, row, col), tile):
+                        return False
+
+            if progress is not None:
+                progress(level + 1, level_count)
+
+        # two windows may be building the pyramid of the same image
+        partial = f"{self.__manifest_path}.part{id(self)}"
+        with open(partial, 'w') as manifest_file:
+            json.dump({'source': self.source, 'tile_size': self.tile_size, 'levels': levels},
+                      manifest_file, indent=2)
+        os.replace(partial, self.__manifest_path)
+
+        self.levels = levels
+        prune_cache(self.cache_root, keep=self.cache_dir)
+        return True
@@ -0,0 +1,261 @@
+"""The Watcher
+
+Runs Thera without the interface against a hot folder: every new or changed
+image dropped into the folder is enlarged with the configured method and scale
+and saved into the output folder.
+
+The progress is recorded in an on-disk journal, so restarting the watcher
+resumes the queue without enlarging the already finished images again.
+
+    python watcher.py incoming/ enlarged/ --method Lanczos --scale X4
+
+"""
+
+import os
+import time
+import sqlite3
+import argparse
+from typing import List, Tuple
+
+import cv2
+
+from model import _Thera, get_upscale
+from checkpoint import CheckpointedJob, CHECKPOINT_MIN_PIXELS
+from frames import FrameStreamEnlarger, supports_frame_streaming
+
+
+# the formats cv2.imread is able to decode, and the animations and
+# multi-page images whose frames are enlarged one at a time
+SUPPORTED_FORMAT = ('bmp', 'jpeg', 'jpg', 'png', 'tif', 'tiff', 'webp', 'gif')
+METHODS = ('Bilinear', 'Cubic', 'Lanczos', 'Super Resolution')
+SCALE_CONVERTER = {'X2': 2, 'X4': 4, 'X8': 8}
+
+
+class JobJournal:
+    """Keep track of the images of the hot folder in a SQLite database
+
+    A job is identified by the image path together with the method and scale,
+    the size and modification time of the image are recorded so that a file
+    replaced by a newer version is enlarged again
+    """
+    def __init__(self, path: str):
+        self.__connection = sqlite3.connect(path)
+
+        with self.__connection:
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "path TEXT NOT NULL, method TEXT NOT NULL, scale INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, mtime REAL NOT NULL, status TEXT NOT NULL, "
+                "output TEXT, error TEXT, updated REAL NOT NULL, "
+                "PRIMARY KEY (path, method, scale))"
+            )
+
+            # a job still marked as running was interrupted by a crash or a kill,
+            # put it back in the queue
+            self.__connection.execute(
+                "UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+
+    def is_done(self, path: str, method: str, scale: int, size: int, mtime: float) -> bool:
+        row = self.__connection.execute(
+            "SELECT size, mtime, status FROM jobs WHERE path = ? AND method = ? AND scale = ?",
+            (path, method, scale)).fetchone()
+
+        # a failed job is not retried until the file changes
+        return row is not None and row[0] == size and row[1] == mtime and row[2] in ('done', 'failed')
+
+    def is_queued(self, path: str, method: str, scale: int, size: int, mtime: float) -> bool:
+        row = self.__connection.execute(
+            "SELECT size, mtime, status FROM jobs WHERE path = ? AND method = ? AND scale = ?",
+            (path, method, scale)).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime and row[2] == 'pending'
+
+    def enqueue(self, path: str, method: str, scale: int, size: int, mtime: float) -> None:
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO jobs (path, method, scale, size, mtime, status, updated) "
+                "VALUES (?, ?, ?, ?, ?, 'pending', ?)",
+                (path, method, scale, size, mtime, time.time()))
+
+    def pending(self, method: str, scale: int) -> List[Tuple[str, int, float]]:
+        return self.__connection.execute(
+            "SELECT path, size, mtime FROM jobs "
+            "WHERE method = ? AND scale = ? AND status = 'pending' ORDER BY updated",
+            (method, scale)).fetchall()
+
+    def set_status(self, path: str, method: str, scale: int, status: str,
+                   output: str = None, error: str = None) -> None:
+        with self.__connection:
+            self.__connection.execute(
+                "UPDATE jobs SET status = ?, output = ?, error = ?, updated = ? "
+                "WHERE path = ? AND method = ? AND scale = ?",
+                (status, output, error, time.time(), path, method, scale))
+
+    def close(self) -> None:
+        self.__connection.close()
+
+
+class HotFolderWatcher:
+    """Poll a folder for new or changed images and enlarge them with _Thera
+
+    An image is only queued once its size and modification time have stayed
+    the same for settle_time seconds, so files that are still being copied
+    into the folder are left alone until they are complete
+    """
+    def __init__(self, source_dir: str, output_dir: str, method: str = 'Bilinear',
+                 scale: str = 'X2', journal_path: str = None,
+                 settle_time: float = 2.0, poll_interval: float = 1.0):
+        if method not in METHODS:
+            raise ValueError(f"Unknown enlargement method: {method}")
+
+        self.source_dir = os.path.abspath(source_dir)
+        self.output_dir = os.path.abspath(output_dir)
+
+        # the enlarged images would otherwise be picked up as new images
+        if self.source_dir == self.output_dir:
+            raise ValueError("The output folder must be different from the watched folder")
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        self.method = method
+        self.scale = SCALE_CONVERTER[scale]
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+
+        if journal_path is None:
+            journal_path = os.path.join(self.output_dir, '.thera_journal.sqlite')
+        self.__journal = JobJournal(journal_path)
+        self.__thera = _Thera()
+
+        # the files that changed recently, path -> (size, mtime, time the
+        # size and mtime were first seen)
+        self.__unsettled = {}
+
+    def scan(self) -> None:
+        """Queue the images of the watched folder that are new or changed
+        and are no longer being written to"""
+        now = time.monotonic()
+        seen = set()
+
+        for entry in os.scandir(self.source_dir):
+            if not entry.is_file() or entry.name.split('.')[-1].lower() not in SUPPORTED_FORMAT:
+                continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            path = entry.path.replace('\\', '/')
+            seen.add(path)
+            signature = (stat.st_size, stat.st_mtime)
+
+            if self.__journal.is_done(path, self.method, self.scale, *signature) or \
+                    self.__journal.is_queued(path, self.method, self.scale, *signature):
+                self.__unsettled.pop(path, None)
+                continue
+
+            # restart the countdown every time the file changes
+            previous = self.__unsettled.get(path)
+            if previous is None or previous[:2] != signature:
+                self.__unsettled[path] = (*signature, now)
+            elif now - previous[2] >= self.settle_time:
+                self.__journal.enqueue(path, self.method, self.scale, *signature)
+                del self.__unsettled[path]
+
+        # forget the files that were removed before they settled
+        for path in set(self.__unsettled) - seen:
+            del self.__unsettled[path]
+
+    def process_pending(self) -> None:
+        for path, size, mtime in self.__journal.pending(self.method, self.scale):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.__journal.set_status(path, self.method, self.scale, 'failed',
+                                          error="The image was removed before it was enlarged")
+                continue
+
+            # the file was changed after it was queued, let it settle again
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.__journal.enqueue(path, self.method, self.scale, stat.st_size, stat.st_mtime)
+                continue
+
+            self.process(path)
+
+    def process(self, path: str) -> None:
+        self.__journal.set_status(path, self.method, self.scale, 'running')
+
+        name, ext = os.path.splitext(os.path.basename(path))
+        output = os.path.join(self.output_dir, f"{name}_x{self.scale}{ext}").replace('\\', '/')
+
+        # one bad file must not take the whole hot folder down, the error is
+        # recorded and the watcher goes on with the other files
+        try:
+            # cv2.imread would only enlarge the first frame or page
+            if supports_frame_streaming(path, output):
+                FrameStreamEnlarger(lambda: self.__thera).run(path, output, self.method, self.scale)
+            else:
+                self.__enlarge_image(path, output)
+        except Exception as e:
+            self.__journal.set_status(path, self.method, self.scale, 'failed', error=str(e))
+            print(f"Failed {path}: {e}")
+            return
+
+        self.__journal.set_status(path, self.method, self.scale, 'done', output=output)
+        print(f"Enlarged {path} -> {output}")
+
+    def __enlarge_image(self, path: str, output: str) -> None:
+        image = cv2.imread(path)
+        if image is None:
+            raise ValueError("This image is corrupted")
+
+        if self.method == 'Super Resolution' and \
+                image.shape[0] * image.shape[1] >= CHECKPOINT_MIN_PIXELS:
+            if not CheckpointedJob(path, output, self.method, self.scale).run(self.__thera, image):
+                raise OSError(f"Could not write the image to {output}")
+        else:
+            image = self.__thera.enlarge(image, get_upscale(image, self.scale), self.method)
+            self.__thera.save_enlarged_image(image, output)
+
+    def run(self, once: bool = False) -> None:
+        """Keep watching the folder until interrupted
+
+        :param once: scan the folder until the images found in it have settled
+            and are enlarged, then return instead of watching forever
+        """
+        # resume the jobs queued before the previous shutdown
+        self.process_pending()
+
+        try:
+            while True:
+                self.scan()
+                self.process_pending()
+
+                if once and not self.__unsettled:
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            self.__journal.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Enlarge the images dropped into a folder")
+    parser.add_argument('source_dir', help="the folder to watch for new images")
+    parser.add_argument('output_dir', help="the folder where the enlarged images are saved")
+    parser.add_argument('--method', choices=METHODS, default='Bilinear')
+    parser.add_argument('--scale', choices=list(SCALE_CONVERTER), default='X2')
+    parser.add_argument('--journal', default=None,
+                        help="path of the job journal, defaults to a file in the output folder")
+    parser.add_argument('--settle-time', type=float, default=2.0,
+                        help="seconds a file must stay unchanged before it is enlarged")
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--once', action='store_true',
+                        help="enlarge the images currently in the folder and exit")
+    args = parser.parse_args()
+
+    watcher = HotFolderWatcher(args.source_dir, args.output_dir, method=args.method,
+                               scale=args.scale, journal_path=args.journal,
+                               settle_time=args.settle_time, poll_interval=args.poll_interval)
+    try:
+        watcher.run(once=args.once)
+    except KeyboardInterrupt:
+        print("Thera is going to sleep")